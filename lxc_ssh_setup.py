@@ -1,266 +1,291 @@
-import os
+import asyncio
+import functools
+import pathlib
+import re
 import subprocess
 import sys
 
+# Upper bound on concurrent pct exec calls, to avoid melting the host
+MAX_CONCURRENCY = 16
+
+# Matches the KEY=value report lines emitted by SETUP_SCRIPT; anything
+# else on stdout (e.g. noise from the container's profile) is ignored
+_REPORT_RE = re.compile(rb'^([A-Z_]+)="?([^"\n]*)"?$', re.M)
+
+# Progress bar glyphs, sliced per tick instead of rebuilt with string multiplies
+_BAR_MAX = 50
+_FULL_BAR = '█' * _BAR_MAX + '-' * _BAR_MAX
+
+
+@functools.lru_cache(maxsize=8)
+def _bar_steps(total, length):
+    """
+    Precompute the percent strings and filled lengths for a bar of total
+    iterations, so each tick is a pair of lookups instead of float math
+    and formatting.
+    :param total: Total iterations
+    :param length: Length of the progress bar
+    :return: Tuple (percent strings, filled lengths), both indexed by iteration
+    """
+    percents = tuple(f"{100 * (i / total):.1f}" for i in range(total + 1))
+    filled = tuple(length * i // total for i in range(total + 1))
+    return percents, filled
+
 
 def print_progress_bar(iteration, total, length=50, message=None, suffix=None):
     """
     Print a progress bar to the console.
     :param iteration: Current iteration
     :param total: Total iterations
-    :param length: Length of the progress bar
+    :param length: Length of the progress bar (at most 50)
     :param message: Message to display above the progress bar
     :param suffix: Suffix to display at the end of the progress bar
     """
+    percents, filled = _bar_steps(total, length)
+    percent = percents[iteration]
+    filled_len = filled[iteration]
+    bar = _FULL_BAR[_BAR_MAX - filled_len:_BAR_MAX + length - filled_len]
+
     if message:
         if iteration > 1:
-            sys.stdout.write('\r\033[F\033[K') # Move to the previous line and clear it
-        sys.stdout.write('\r\033[K')  # Return to the start of the line and clear it
+            sys.stdout.write('\x1b[F\x1b[2K') # Move to the previous line and erase it
+        sys.stdout.write('\x1b[2K\r')  # Erase the line and return to its start
         print(message)  # Print the message above the progress bar
 
-    percent = f"{100 * (iteration / float(total)):.1f}"
-    filled_len = int(length * iteration // total)
-    bar = '█' * filled_len + '-' * (length - filled_len)
     if iteration > 1 and not message:
-        sys.stdout.write('\r\033[F\033[K') # Move to the previous line and clear it
-    sys.stdout.write(f'\rProgress: |{bar}| {percent}% Complete - {iteration}/{total} - {suffix if suffix else ""}\n')
+        sys.stdout.write('\x1b[F\x1b[2K') # Move to the previous line and erase it
+    sys.stdout.write(f'\x1b[2K\rProgress: |{bar}| {percent}% Complete - {iteration}/{total} - {suffix if suffix else ""}\n')
     sys.stdout.flush()
     if iteration == total:
         print()  # Move to the next line
 
 
-def run_command_silently(command):
+@functools.lru_cache(maxsize=1)
+def load_keys(key_file='keys.pub'):
     """
-    Run a shell command silently, suppressing stdout and stderr.
-    :param command: The command to run
-    :return: The result of subprocess.run
+    Read the public keys from key_file, caching the result so the file is
+    only touched once per run regardless of container count.
+    :param key_file: Path to the file containing public keys
+    :return: The keys as a string, or None if the file is missing or empty
     """
-    return subprocess.run(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True)
+    try:
+        keys = pathlib.Path(key_file).read_text().strip()
+    except FileNotFoundError:
+        return None
+    return keys or None
 
 
 def get_lxc_containers():
     """
     Get a list of LXC containers
-    :return: Dictionary with container names as keys and their IDs and running status as values
+    :return: Dictionary with container names as keys and their IDs, running status
+             and the fixed pct exec argv prefix as values
     """
-    # Run the command to get the list of containers
-    result = subprocess.run(['pct', 'list'], capture_output=True, text=True)
+    # Run the command to get the list of containers; only stdout is parsed
+    result = subprocess.run(['pct', 'list'], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
     containers = {}
     for line in result.stdout.splitlines()[1:]:
-        line = " ".join(line.split()).split()  # split on multiple spaces
-        containers[line[2]] = {
-            'vmid': line[0],
-            'running': line[1] == 'running'
+        parts = line.split(None, 3)  # split on runs of whitespace, one pass
+        containers[parts[2]] = {
+            'vmid': parts[0],
+            'running': parts[1] == 'running',
+            'argv': ('pct', 'exec', parts[0], '--', 'sh', '-s', '--')
         }
     return containers
 
 
-def get_linux_version(vmid) -> dict:
-    """
-    Get the Linux version of the container
-    :param vmid: Container ID
-    :return: Dictionary with the version information
-    """
-    result = subprocess.run(f"pct exec {vmid} -- cat /etc/os-release".split(),
-                            capture_output=True,
-                            text=True)
-    return {item[0].lower(): item[1].replace('"', '')
-            for item in [
-                line.split("=") for line in result.stdout.splitlines()
-                ]}
-
-
-def install_openssh(container) -> tuple[bool, str]:
-    """
-    Check if OpenSSH is installed in the container and install it if not.
-    Also, ensure the SSH service is running and set to start on boot.
-    :param container: Container data
-    :return: Tuple (True if OpenSSH was installed or configured, False if it was already installed and configured, and a message)
-    """
-    # Command to check if OpenSSH is installed
-    check_command = f"pct exec {container['vmid']} -- sh -c 'command -v sshd > /dev/null 2>&1'"
-    check_result = subprocess.run(check_command, shell=True, capture_output=True, text=True)
-
-    if check_result.returncode == 0:
-        # Check if the SSH service is running and enabled
-        if container['version']['id'] == 'alpine':
-            service_check_command = (
-                f"pct exec {container['vmid']} -- sh -c "
-                f"'rc-update show | grep sshd | grep -q default && rc-service sshd status | grep -q started'"
-            )
-        else:
-            service_check_command = (
-                f"pct exec {container['vmid']} -- sh -c "
-                f"'systemctl is-enabled ssh && systemctl is-active ssh'"
-            )
-
-        service_check_result = subprocess.run(service_check_command, shell=True, capture_output=True, text=True)
-
-        if service_check_result.returncode == 0:
-            return False, f"OpenSSH is already installed and properly configured."
-        else:
-            # Start and enable the SSH service
-            if container['version']['id'] == 'alpine':
-                configure_command = (
-                    f"pct exec {container['vmid']} -- sh -c "
-                    f"'rc-update add sshd && rc-service sshd start'"
-                )
-            else:
-                configure_command = (
-                    f"pct exec {container['vmid']} -- sh -c "
-                    f"'systemctl enable ssh && systemctl start ssh'"
-                )
-            run_command_silently(configure_command)
-            return True, f"SSH service started and enabled."
-
-    # Determine the package manager and install OpenSSH
-    if container['version']['id'] == 'alpine':
-        install_command = (
-            f"pct exec {container['vmid']} -- sh -c "
-            f"'apk add --no-cache openssh && rc-update add sshd && rc-service sshd start'"
-        )
-    elif container['version']['id'] in ['debian', 'ubuntu']:
-        install_command = (
-            f"pct exec {container['vmid']} -- sh -c "
-            f"'apt-get update && apt-get install -y openssh-server && systemctl enable ssh && systemctl start ssh'"
-        )
-    elif container['version']['id'] in ['centos', 'rhel', 'fedora']:
-        install_command = (
-            f"pct exec {container['vmid']} -- sh -c "
-            f"'yum install -y openssh-server && systemctl enable sshd && systemctl start sshd'"
-        )
-    else:
-        return False, f"Unsupported Linux distribution, {container['version']['id']}."
-
-    # Run the installation command
-    install_result = subprocess.run(install_command, shell=True, capture_output=True, text=True)
-
-    if install_result.returncode != 0:
-        return False, f"Failed to install OpenSSH in container {container['vmid']}: {install_result.stderr.strip()}"
-
-    return True, f"OpenSSH successfully installed and configured in container {container['vmid']}."
-
-
-def set_ssh_password_authentication(container, status='no') -> tuple[bool, str]:
-    """
-    Set ssh password authentication to yes or no
-    :param container: Container data
-    :param status: yes or no
-    :return: tuple (True if changed, False if not, and a message)
-    """
-    command = (
-        f"pct exec {container['vmid']} -- sh -c "
-        f"'[ -f /etc/ssh/sshd_config ] && grep PasswordAuthentication /etc/ssh/sshd_config || exit 1'"
-    )
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-
-    # If the file doesn't exist or grep fails, return False
-    if result.returncode != 0:
-        return True, "SSH not installed or not configured."
-
-    # Check if PasswordAuthentication is already set to the desired status
-    for line in result.stdout.splitlines():
-        if line.startswith(f'PasswordAuthentication {status}'):
-            return False, "Already set to the desired status."
-
-    # If not okay, update the configuration
-    command = f"pct exec {container['vmid']} -- sed -E -i 's|^#?(PasswordAuthentication)\\s.*|\\1 {status}|' /etc/ssh/sshd_config"
-    subprocess.run(command, shell=True)
-    
-    # Restart the SSH service
-    if container['version']['id'] == 'alpine':
-        subprocess.run(f"pct exec {container['vmid']} -- service ssh restart".split())
-    else:
-        subprocess.run(f"pct exec {container['vmid']} -- systemctl restart ssh".split())
-    
-    return True, f"PasswordAuthentication set to {status}"
-
-
-def add_ssh_public_keys(container, key_file='keys.pub', remove_existing=True) -> tuple[bool, str]:
-    """
-    Add keys from key_file to container using a single pct exec command.
-    :param container: Container data
-    :param key_file: Path to the file containing public keys
-    :param remove_existing: If True, remove existing keys before adding new ones
-    :return: Tuple (True if keys were added, False if not, and a message)
-    """
-    # Check if the key file exists
-    try:
-        with open(key_file, 'r') as f:
-            keys = f.read().strip()
-    except FileNotFoundError:
-        return False, f"Key file '{key_file}' not found."
-
-    if not keys:
-        return False, "Key file is empty."
-
-    # Shell script content
-    script_content = """
+# Shell script that configures a container in a single pct exec.
+# It installs OpenSSH if needed, enables and starts the service, sets
+# PasswordAuthentication and updates the authorized keys, reporting each
+# step as a KEY=value line on stdout. The script is piped over stdin with
+# `sh -s -- <keys> <remove_existing> <password_auth>` so the values are
+# passed as positional arguments and never interpolated into shell code.
+SETUP_SCRIPT = """
 #!/bin/sh
 
 KEYS="$1"
 REMOVE_EXISTING="$2"
+PASSWORD_AUTH="$3"
 AUTHORIZED_KEYS="/root/.ssh/authorized_keys"
 
-# Ensure the .ssh directory exists
-mkdir -p /root/.ssh
-chmod 700 /root/.ssh
-
-# Read the existing authorized_keys file into memory
-if [ -f "$AUTHORIZED_KEYS" ]; then
-    EXISTING_KEYS=$(cat "$AUTHORIZED_KEYS")
+# Install OpenSSH if needed, otherwise make sure the service is enabled and running
+if command -v sshd > /dev/null 2>&1; then
+    printf 'SSHD=present\\n'
+    if command -v systemctl > /dev/null 2>&1; then
+        if systemctl is-enabled ssh > /dev/null 2>&1 && systemctl is-active ssh > /dev/null 2>&1; then
+            printf 'SERVICE=ok\\n'
+        else
+            systemctl enable ssh > /dev/null 2>&1 && systemctl start ssh > /dev/null 2>&1
+            printf 'SERVICE=started\\n'
+        fi
+    else
+        if rc-update show | grep sshd | grep -q default && rc-service sshd status | grep -q started; then
+            printf 'SERVICE=ok\\n'
+        else
+            rc-update add sshd > /dev/null 2>&1 && rc-service sshd start > /dev/null 2>&1
+            printf 'SERVICE=started\\n'
+        fi
+    fi
 else
-    EXISTING_KEYS=""
+    # Only consult os-release when a package install is actually needed
+    . /etc/os-release
+    printf 'ID=%s\\n' "$ID"
+    case "$ID" in
+        alpine)
+            INSTALL_CMD="apk add --no-cache openssh && rc-update add sshd && rc-service sshd start" ;;
+        debian|ubuntu)
+            INSTALL_CMD="apt-get update && apt-get install -y openssh-server && systemctl enable ssh && systemctl start ssh" ;;
+        centos|rhel|fedora)
+            INSTALL_CMD="yum install -y openssh-server && systemctl enable sshd && systemctl start sshd" ;;
+        *)
+            INSTALL_CMD="" ;;
+    esac
+    if [ -z "$INSTALL_CMD" ]; then
+        printf 'SSHD=unsupported\\n'
+        exit 0
+    fi
+    if eval "$INSTALL_CMD" > /dev/null 2>&1; then
+        printf 'SSHD=installed\\n'
+    else
+        printf 'SSHD=failed\\n'
+        exit 0
+    fi
 fi
 
-# Update the keys in memory
-if [ "$REMOVE_EXISTING" = "true" ]; then
-    UPDATED_KEYS="$KEYS"
-else
-    UPDATED_KEYS="$EXISTING_KEYS"
-    echo "$KEYS" | while IFS= read -r key; do
-        if ! echo "$EXISTING_KEYS" | grep -qxF "$key"; then
-            UPDATED_KEYS="$UPDATED_KEYS
-$key"
+# Set PasswordAuthentication, but only rewrite the file and restart the
+# service when the rendered config actually differs from what is on disk,
+# so steady-state re-runs never pay the sshd restart.
+if [ -f /etc/ssh/sshd_config ]; then
+    NEW_CONFIG=$(sed -E "s|^#?(PasswordAuthentication)\\s.*|\\1 $PASSWORD_AUTH|" /etc/ssh/sshd_config)
+    if [ "$NEW_CONFIG" = "$(cat /etc/ssh/sshd_config)" ]; then
+        printf 'AUTH=ok\\n'
+    else
+        printf '%s\\n' "$NEW_CONFIG" > /etc/ssh/sshd_config
+        if command -v systemctl > /dev/null 2>&1; then
+            systemctl restart ssh > /dev/null 2>&1
+        else
+            service ssh restart > /dev/null 2>&1
         fi
-    done
-fi
-
-# Compare the updated keys with the existing keys
-if [ "$UPDATED_KEYS" = "$EXISTING_KEYS" ]; then
-    # No changes were made
-    exit 0
+        printf 'AUTH=changed\\n'
+    fi
 else
-    # Changes were made, write the updated keys back to the file
-    echo "$UPDATED_KEYS" > "$AUTHORIZED_KEYS"
-    chmod 600 "$AUTHORIZED_KEYS"
-    exit 1
+    printf 'AUTH=missing\\n'
 fi
 
-# If something unexpected happens, return an error code
-exit 2
+# Update the authorized keys
+if [ -n "$KEYS" ]; then
+    mkdir -p /root/.ssh
+    chmod 700 /root/.ssh
+
+    # Read the existing authorized_keys file into memory
+    if [ -f "$AUTHORIZED_KEYS" ]; then
+        EXISTING_KEYS=$(cat "$AUTHORIZED_KEYS")
+    else
+        EXISTING_KEYS=""
+    fi
+
+    # Update the keys in memory
+    if [ "$REMOVE_EXISTING" = "true" ]; then
+        UPDATED_KEYS="$KEYS"
+    else
+        # Merge and dedupe in a single awk pass instead of one grep per key
+        UPDATED_KEYS=$(printf '%s\\n%s\\n' "$EXISTING_KEYS" "$KEYS" | awk 'NF && !seen[$0]++')
+    fi
+
+    # Only write the file back if the keys actually changed
+    if [ "$UPDATED_KEYS" = "$EXISTING_KEYS" ]; then
+        printf 'KEYS=ok\\n'
+    else
+        echo "$UPDATED_KEYS" > "$AUTHORIZED_KEYS"
+        chmod 600 "$AUTHORIZED_KEYS"
+        printf 'KEYS=changed\\n'
+    fi
+fi
 """
 
-    # Replace $1 and $2 placeholders with the actual values
-    script_content = script_content.replace("$1", keys).replace("$2", "true" if remove_existing else "false")
 
-    # Execute the script in the container
-    command = f"pct exec {container['vmid']} -- sh -c '{script_content}'"
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
+async def setup_container(container, keys=None, remove_existing=True, password_auth='no') -> tuple[bool, str | None]:
+    """
+    Configure SSH access in a container with a single pct exec call.
+    The batched script is piped over stdin and its KEY=value report is
+    parsed to build the per-stage messages.
+    :param container: Container data
+    :param keys: Public keys to install, or None to skip the keys step
+    :param remove_existing: If True, remove existing keys before adding new ones
+    :param password_auth: Desired PasswordAuthentication value, yes or no
+    :return: Tuple (True if anything changed or failed, False if not, and a message)
+    """
+    proc = await asyncio.create_subprocess_exec(*container['argv'],
+                                                keys if keys else '',
+                                                'true' if remove_existing else 'false',
+                                                password_auth,
+                                                stdin=asyncio.subprocess.PIPE,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate(SETUP_SCRIPT.encode())
+
+    if proc.returncode != 0:
+        # stderr is only decoded on the failure path, it is discarded otherwise
+        return True, f"Failed to configure container: {stderr.decode().strip()}"
+
+    report = {m.group(1).decode(): m.group(2).decode()
+              for m in _REPORT_RE.finditer(stdout)}
+    messages = []
+    if report.get('SSHD') == 'installed':
+        messages.append("OpenSSH successfully installed")
+    elif report.get('SSHD') == 'unsupported':
+        messages.append(f"Unsupported Linux distribution, {report.get('ID')}")
+    elif report.get('SSHD') == 'failed':
+        messages.append("Failed to install OpenSSH")
+    if report.get('SERVICE') == 'started':
+        messages.append("SSH service started and enabled")
+    if report.get('AUTH') == 'changed':
+        messages.append(f"PasswordAuthentication set to {password_auth}")
+    if report.get('KEYS') == 'changed':
+        messages.append("SSH keys successfully added")
+
+    if messages:
+        return True, '; '.join(messages)
+    return False, None
+
+
+async def run_parallel_stage(containers, worker):
+    """
+    Run a stage worker for each running container on the event loop.
+    The stage is dominated by `pct exec` latency, so containers are
+    processed concurrently, bounded by MAX_CONCURRENCY, and the progress
+    bar is updated as results complete. Containers that are not running
+    are reported and skipped.
+    :param worker: Coroutine (name, data) returning a message to display or None
+    """
+    total = len(containers)
+    done = 0
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
 
-    # Handle the exit code
-    if result.returncode == 0:
-        return False, f"No changes were made to container."
-    elif result.returncode == 1:
-        return True, f"SSH keys successfully added to container."
-    else:
-        return True, f"Failed to add SSH keys to container: {result.stderr.strip()}"
+    async def bounded(name, data):
+        async with semaphore:
+            return name, await worker(name, data)
+
+    tasks = []
+    for name, data in containers.items():
+        if data['running']:
+            tasks.append(asyncio.ensure_future(bounded(name, data)))
+        else:
+            done += 1
+            print_progress_bar(done, total,
+                               message=f"Container {name} ({data['vmid']}) is not running.",
+                               suffix=name)
+    for task in asyncio.as_completed(tasks):
+        name, message = await task
+        done += 1
+        print_progress_bar(done, total, message=message, suffix=name)
 
 
 def main(lxc_id=None):
     print('Getting containers IDs.')
     all_containers = get_lxc_containers()
-    
+
     # Filter containers if a specific ID is provided
     if lxc_id:
         containers = {name: data for name, data in all_containers.items() if data['vmid'] == lxc_id}
@@ -269,55 +294,17 @@ def main(lxc_id=None):
             sys.exit(1)
     else:
         containers = all_containers
-    
-    container_count = len(containers)
-    message = None
-
-    print('\nGetting container operating system info:')
-    for i, (name, data) in enumerate(containers.items()):
-        print_progress_bar(i+1, container_count, message=message, suffix=name)
-        if data['running']:
-            containers[name]['version'] = get_linux_version(data['vmid'])
-            message = None
-        else:
-            message = f"Container {name} ({data['vmid']}) is not running."
 
-    print('\nInstalling OpenSSH into containers if needed:')
-    for i, (name, data) in enumerate(containers.items()):
-        print_progress_bar(i+1, container_count, message=message, suffix=name)
-        message = None
-        if data['running']:
-            result, message = install_openssh(containers[name])
-            if result:
-                message = f"Container {name} ({data['vmid']}) {message}"
-            else:
-                message = None
-
-    print('\nDisabling SSH password authentication in containers:')
-    for i, (name, data) in enumerate(containers.items()):
-        print_progress_bar(i+1, container_count, message=message, suffix=name)
-        message = None
-        if data['running']:
-            result, message = set_ssh_password_authentication(containers[name], 'no')
-            if result:
-                message = f"Container {name} ({data['vmid']}) {message}"
-            else:
-                message = None  
-
-    if os.path.exists('keys.pub'):
-        print('\nReplacing public SSH keys in containers:')
-        for i, (name, data) in enumerate(containers.items()):
-            print_progress_bar(i+1, container_count, message=message, suffix=name)
-            message = None
-            if data['running']:
-                result, message = add_ssh_public_keys(containers[name])
-                if result:
-                    message = f"Container {name} ({data['vmid']}) {message}"
-                else:
-                    message = None
-    else:
+    keys = load_keys()
+    if keys is None:
         print('\nReplacing public SSH keys is not possible. Create keys.pub file.')
 
+    print('\nConfiguring SSH access in containers:')
+    async def configure_stage(name, data):
+        result, message = await setup_container(data, keys)
+        return f"Container {name} ({data['vmid']}) {message}" if result else None
+    asyncio.run(run_parallel_stage(containers, configure_stage))
+
 
 if __name__ == "__main__":
     lxc_id = sys.argv[1] if len(sys.argv) > 1 else None